@@ -0,0 +1,103 @@
+import json
+import unittest
+
+from zmsg.rpc import Proxy, httplib
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self._body = json.dumps(data).encode('utf8')
+
+    def read(self):
+        return self._body
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class FakeConnection(object):
+    """Stands in for httplib.HTTPConnection.
+
+    A stale socket is one zcashd closed while it was idle: sending on it
+    either raises ``stale_error`` or is lost, and no response comes back.
+    ``reset_after_send`` makes a live server run the request and then drop
+    the connection without answering.
+    """
+
+    def __init__(self, stale_error=None, reset_after_send=False):
+        self.sock = object() if stale_error is not None else None
+        self.stale_error = stale_error
+        self.reset_after_send = reset_after_send
+        self.received = []
+
+    def close(self):
+        self.sock = None
+        self.stale_error = None
+
+    def request(self, method, url, body, headers):
+        if self.sock is None:
+            self.sock = object()
+        elif self.stale_error is BrokenPipeError:
+            raise BrokenPipeError()
+        if self.stale_error is None:
+            self.received.append(json.loads(body))
+
+    def getresponse(self):
+        if self.stale_error is not None or self.reset_after_send:
+            self.sock = None
+            raise httplib.RemoteDisconnected('Remote end closed connection')
+        req = self.received[-1]
+        return FakeResponse({'result': req['method'], 'error': None, 'id': req['id']})
+
+
+def make_proxy(conn):
+    p = Proxy(network='testnet', service_url='http://u:p@127.0.0.1:18232')
+    p._BaseProxy__conn = conn
+    return p
+
+
+class TestRequestRetry(unittest.TestCase):
+    def received_methods(self, conn):
+        return [req['method'] for req in conn.received]
+
+    def test_stale_socket_read_is_retried(self):
+        for error in (BrokenPipeError, httplib.RemoteDisconnected):
+            conn = FakeConnection(stale_error=error)
+            p = make_proxy(conn)
+            self.assertEqual(p.call('getinfo'), 'getinfo')
+            self.assertEqual(self.received_methods(conn), ['getinfo'])
+
+    def test_stale_socket_sendmany_uses_fresh_connection(self):
+        for error in (BrokenPipeError, httplib.RemoteDisconnected):
+            conn = FakeConnection(stale_error=error)
+            p = make_proxy(conn)
+            self.assertEqual(p.z_sendmany('zfrom', []), 'z_sendmany')
+            self.assertEqual(self.received_methods(conn), ['z_sendmany'])
+
+    def test_fresh_socket_disconnect_is_not_retried(self):
+        conn = FakeConnection(reset_after_send=True)
+        p = make_proxy(conn)
+        with self.assertRaises(httplib.RemoteDisconnected):
+            p.call('getinfo')
+        self.assertEqual(self.received_methods(conn), ['getinfo'])
+
+    def test_sendmany_disconnect_is_not_retried(self):
+        conn = FakeConnection(reset_after_send=True)
+        p = make_proxy(conn)
+        with self.assertRaises(httplib.RemoteDisconnected):
+            p.z_sendmany('zfrom', [])
+        self.assertEqual(self.received_methods(conn), ['z_sendmany'])
+
+
+class TestBatchCall(unittest.TestCase):
+    def test_wallet_changing_methods_are_rejected(self):
+        conn = FakeConnection()
+        p = make_proxy(conn)
+        for method in ('z_sendmany', 'z_getnewaddress'):
+            with self.assertRaises(ValueError):
+                p.batch_call(method, [[]])
+        self.assertEqual(conn.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
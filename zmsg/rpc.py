@@ -8,20 +8,41 @@ except ImportError:
     import httplib
 import base64
 import binascii
+import copy
 import decimal
+import functools
+import itertools
 import json
 import os
 import platform
+import re
 import sys
 try:
     import urllib.parse as urlparse
 except ImportError:
     import urlparse
 
+from .utils import TTLCache
+
 DEFAULT_USER_AGENT = "AuthServiceProxy/0.1"
 
 DEFAULT_HTTP_TIMEOUT = 30
 
+DEFAULT_CACHE_TTL = 20
+
+CACHE_SIZE = 8
+
+# RPC methods that change the wallet's addresses or unspent outputs; calling
+# one invalidates cached wallet queries, and none of them is ever retried
+WALLET_CHANGING_METHODS = frozenset([
+    'getnewaddress', 'importaddress', 'importprivkey', 'importwallet',
+    'sendmany', 'sendtoaddress', 'z_getnewaddress', 'z_importkey',
+    'z_importwallet', 'z_sendmany', 'z_shieldcoinbase',
+])
+
+# One 'key=value' setting of zcash.conf, ignoring any '#' comment
+_CONF_RE = re.compile(r'^[ \t]*([^\s=#]+)[ \t]*=[ \t]*([^#\r\n]*?)[ \t\r]*(?:#.*)?$', re.M)
+
 class JSONRPCError(Exception):
     """JSON-RPC protocol error base class
 
@@ -77,6 +98,38 @@ class VerifyAlreadyInChainError(JSONRPCError):
 class InWarmupError(JSONRPCError):
     RPC_ERROR_CODE = -28
 
+@functools.lru_cache(maxsize=4)
+def _load_zcash_conf(zcash_conf_file, service_port):
+    """Build the service URL from zcash.conf
+
+    Cached, so the file is read once per process for each
+    (zcash_conf_file, service_port) pair.
+    """
+    # Figure out the path to the zcash.conf file
+    if zcash_conf_file is None:
+        if platform.system() == 'Windows':
+            zcash_conf_file = os.path.join(os.environ['APPDATA'], 'Zcash')
+        else:
+            zcash_conf_file = os.path.expanduser('~/.zcash')
+        zcash_conf_file = os.path.join(zcash_conf_file, 'zcash.conf')
+
+    # Extract contents of zcash.conf to build service_url
+    with open(zcash_conf_file, 'r') as fd:
+        # zcash accepts empty rpcuser, not specified in zcash_conf_file
+        conf = {'rpcuser': ""}
+        conf.update(_CONF_RE.findall(fd.read()))
+
+        conf['rpcport'] = int(conf.get('rpcport', service_port))
+        conf['rpchost'] = conf.get('rpcconnect', 'localhost')
+
+        if 'rpcpassword' not in conf:
+            raise ValueError('The value of rpcpassword not specified in the configuration file: %s' % zcash_conf_file)
+
+    return ('%s://%s:%s@%s:%d' %
+        ('http',
+         conf['rpcuser'], conf['rpcpassword'],
+         conf['rpchost'], conf['rpcport']))
+
 class BaseProxy(object):
     """Base JSON-RPC proxy class. Contains only private methods; do not use
     directly."""
@@ -101,38 +154,7 @@ class BaseProxy(object):
             raise Exception("Please specify network='testnet' or 'mainnet'")
 
         if service_url is None:
-            # Figure out the path to the zcash.conf file
-            if zcash_conf_file is None:
-                if platform.system() == 'Windows':
-                    zcash_conf_file = os.path.join(os.environ['APPDATA'], 'Zcash')
-                else:
-                    zcash_conf_file = os.path.expanduser('~/.zcash')
-                zcash_conf_file = os.path.join(zcash_conf_file, 'zcash.conf')
-
-            # Extract contents of zcash.conf to build service_url
-            with open(zcash_conf_file, 'r') as fd:
-                # zcash accepts empty rpcuser, not specified in zcash_conf_file
-                conf = {'rpcuser': ""}
-                for line in fd.readlines():
-                    if '#' in line:
-                        line = line[:line.index('#')]
-                    if '=' not in line:
-                        continue
-                    k, v = line.split('=', 1)
-                    conf[k.strip()] = v.strip()
-
-                if service_port is None:
-                    service_port = network
-                conf['rpcport'] = int(conf.get('rpcport', service_port))
-                conf['rpchost'] = conf.get('rpcconnect', 'localhost')
-
-                if 'rpcpassword' not in conf:
-                    raise ValueError('The value of rpcpassword not specified in the configuration file: %s' % zcash_conf_file)
-
-                service_url = ('%s://%s:%s@%s:%d' %
-                    ('http',
-                     conf['rpcuser'], conf['rpcpassword'],
-                     conf['rpchost'], conf['rpcport']))
+            service_url = _load_zcash_conf(zcash_conf_file, service_port)
 
         self.__service_url = service_url
         self.__url = urlparse.urlparse(service_url)
@@ -144,46 +166,112 @@ class BaseProxy(object):
             port = httplib.HTTP_PORT
         else:
             port = self.__url.port
-        self.__id_count = 0
+        self.__id_iter = itertools.count(1)
         authpair = "%s:%s" % (self.__url.username, self.__url.password)
         authpair = authpair.encode('utf8')
         self.__auth_header = b"Basic " + base64.b64encode(authpair)
+        # Identical for every request; httplib does not modify it
+        self.__headers = {'Host': self.__url.hostname,
+                          'User-Agent': DEFAULT_USER_AGENT,
+                          'Authorization': self.__auth_header,
+                          'Content-type': 'application/json',
+                          'Connection': 'keep-alive'}
 
         self.__conn = httplib.HTTPConnection(self.__url.hostname, port=port,
                                              timeout=timeout)
 
 
-    def _call(self, service_name, *args):
-        self.__id_count += 1
+    def _call(self, service_name, *args, retry=True):
+        """Call an RPC method
 
+        Pass ``retry=False`` for calls that must not be sent twice, such as
+        ``z_sendmany``.
+        """
         postdata = json.dumps({'version': '1.1',
                                'method': service_name,
                                'params': args,
-                               'id': self.__id_count})
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': DEFAULT_USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
-
-        response = self._get_response()
-        if response['error'] is not None:
-            raise JSONRPCError(response['error'])
-        elif 'result' not in response:
+                               'id': next(self.__id_iter)}).encode('utf8')
+        response = self._request_with_retry(postdata, self.__headers, retry)
+        error = response.get('error')
+        if error is not None:
+            raise JSONRPCError(error)
+        try:
+            return response['result']
+        except KeyError:
+            raise JSONRPCError({
+                'code': -343, 'message': 'missing JSON-RPC result'}) from None
+
+
+    def _batch_call(self, service_name, params_list):
+        """Call one RPC method once per entry of params_list in a single
+        JSON-RPC batch; return the results in the same order"""
+        if not params_list:
+            return []
+        index_by_id = {}
+        calls = []
+        for i, params in enumerate(params_list):
+            call_id = next(self.__id_iter)
+            index_by_id[call_id] = i
+            calls.append({'version': '1.1',
+                          'method': service_name,
+                          'params': params,
+                          'id': call_id})
+
+        responses = self._batch(calls)
+        if not isinstance(responses, list):
+            # A rejected batch is answered with a single error object
+            error = isinstance(responses, dict) and responses.get('error')
+            raise JSONRPCError(error or {
+                'code': -344, 'message': 'invalid JSON-RPC batch response'})
+
+        results = [None] * len(calls)
+        for response in responses:
+            error = response.get('error')
+            if error is not None:
+                raise JSONRPCError(error)
+            try:
+                results[index_by_id.pop(response['id'])] = response['result']
+            except KeyError:
+                raise JSONRPCError({
+                    'code': -343, 'message': 'missing JSON-RPC result'}) from None
+        if index_by_id:
             raise JSONRPCError({
                 'code': -343, 'message': 'missing JSON-RPC result'})
-        else:
-            return response['result']
-
+        return results
 
     def _batch(self, rpc_call_list):
-        postdata = json.dumps(list(rpc_call_list))
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': DEFAULT_USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
-
+        postdata = json.dumps(list(rpc_call_list)).encode('utf8')
+        return self._request_with_retry(postdata, self.__headers)
+
+    def _request_with_retry(self, postdata, headers, retry=True):
+        # zcashd may close a kept-alive connection while it is idle.
+        if not retry:
+            # A call that must not be sent twice goes out on a fresh
+            # connection, so it can never hit a stale socket.
+            if self.__conn.sock is not None:
+                self.__conn.close()
+            self.__conn.request('POST', self.__url.path, postdata, headers)
+            return self._get_response()
+
+        # Otherwise retry once, on a fresh socket, when the request cannot
+        # have reached the server: sending it failed, or a reused connection
+        # was closed without any response.
+        reused = self.__conn.sock is not None
+        try:
+            self.__conn.request('POST', self.__url.path, postdata, headers)
+        except BrokenPipeError:
+            return self._resend(postdata, headers)
+        try:
+            return self._get_response()
+        except httplib.RemoteDisconnected:
+            if not reused:
+                raise
+            return self._resend(postdata, headers)
+
+    def _resend(self, postdata, headers):
+        # Closing the connection makes httplib open a new socket
+        self.__conn.close()
+        self.__conn.request('POST', self.__url.path, postdata, headers)
         return self._get_response()
 
     def _get_response(self):
@@ -192,8 +280,12 @@ class BaseProxy(object):
             raise JSONRPCError({
                 'code': -342, 'message': 'missing HTTP response from server'})
 
-        return json.loads(http_response.read().decode('utf8'),
-                          parse_float=decimal.Decimal)
+        # Always drain the body so the connection can be reused
+        body = http_response.read()
+        if http_response.getheader('Connection', '').lower() == 'close':
+            self.__conn.close()
+
+        return json.loads(body.decode('utf8'), parse_float=decimal.Decimal)
 
     def __del__(self):
         if self.__conn is not None:
@@ -214,6 +306,7 @@ class Proxy(BaseProxy):
                  service_port=None,
                  zcash_conf_file=None,
                  timeout=DEFAULT_HTTP_TIMEOUT,
+                 cache_ttl=DEFAULT_CACHE_TTL,
                  **kwargs):
         """Create a proxy object
 
@@ -227,6 +320,9 @@ class Proxy(BaseProxy):
         be used.
 
         ``timeout`` - timeout in seconds before the HTTP interface times out
+
+        ``cache_ttl`` - seconds to reuse results of wallet queries that rarely
+        change (``z_listaddresses``, ``listunspent``); 0 disables caching
         """
 
         super(Proxy, self).__init__(service_url=service_url,
@@ -234,11 +330,48 @@ class Proxy(BaseProxy):
                                     zcash_conf_file=zcash_conf_file,
                                     timeout=timeout,
                                     **kwargs)
+        self.__cache_ttl = cache_ttl
+        self.__cache = TTLCache(CACHE_SIZE)
+
+    def _cached_call(self, service_name, *args):
+        """Like ``_call``, but reuse a result younger than ``cache_ttl``
+
+        Callers get a copy, so modifying a result does not alter the cache.
+        """
+        if not self.__cache_ttl:
+            return self._call(service_name, *args)
+        key = (service_name,) + args
+        r = self.__cache.get(key)
+        if r is None:
+            r = self._call(service_name, *args)
+            self.__cache.set(key, r, self.__cache_ttl)
+        return copy.deepcopy(r)
+
+    def _wallet_call(self, service_name, *args):
+        """Call a method in ``WALLET_CHANGING_METHODS``, without retrying,
+        and invalidate the cached wallet queries"""
+        try:
+            return self._call(service_name, *args, retry=False)
+        finally:
+            self.__cache.clear()
 
     def call(self, service_name, *args):
         """Call an RPC method by name and raw (JSON encodable) arguments"""
+        if service_name in WALLET_CHANGING_METHODS:
+            return self._wallet_call(service_name, *args)
         return self._call(service_name, *args)
 
+    def batch_call(self, service_name, params_list):
+        """Call an RPC method once per argument list in params_list, sending
+        all calls as one JSON-RPC batch; results are returned in order
+
+        Batches may be resent after a dropped connection, so methods in
+        ``WALLET_CHANGING_METHODS`` are rejected; use ``call`` for those.
+        """
+        if service_name in WALLET_CHANGING_METHODS:
+            raise ValueError('%s changes the wallet and cannot be batched' % service_name)
+        return self._batch_call(service_name, params_list)
+
     def gettransaction(self, txid, includeWatchonly=False):
         """Get detailed information about in-wallet transaction txid
 
@@ -248,7 +381,7 @@ class Proxy(BaseProxy):
 
         FIXME: Returned data types are not yet converted.
         """
-        if type(txid) == str:
+        if isinstance(txid, str):
             r = self._call('gettransaction', txid)
         else:
             try:
@@ -267,10 +400,11 @@ class Proxy(BaseProxy):
         """
         r = None
         if addrs is None:
-            r = self._call('listunspent', minconf, maxconf)
+            r = self._cached_call('listunspent', minconf, maxconf)
         else:
-            addrs = [str(addr) for addr in addrs]
-            r = self._call('listunspent', minconf, maxconf, addrs)
+            addrs = tuple(addr if isinstance(addr, str) else str(addr)
+                          for addr in addrs)
+            r = self._cached_call('listunspent', minconf, maxconf, addrs)
         return r
 
     def z_getoperationresult(self, opid):
@@ -290,12 +424,14 @@ class Proxy(BaseProxy):
 
     def z_listreceivedbyaddress(self, zaddr, minconf=1):
         """Return a list of amounts received by a zaddr belonging to the node’s wallet."""
-        r = self._call('z_listreceivedbyaddress', str(zaddr), minconf)
+        if not isinstance(zaddr, str):
+            zaddr = str(zaddr)
+        r = self._call('z_listreceivedbyaddress', zaddr, minconf)
         return r
 
     def z_listaddresses(self):
         """Returns the list of zaddr belonging to the wallet."""
-        return self._call('z_listaddresses')
+        return self._cached_call('z_listaddresses')
 
     def z_sendmany(self, fromaddress, amounts, minconf=1, fee=0.0001):
         """Send multiple times. Amounts are double-precision floating point numbers.
@@ -312,6 +448,7 @@ class Proxy(BaseProxy):
         3. minconf               (numeric, optional, default=1) Only use funds confirmed at least this many times.
         4. fee                   (numeric, optional, default=0.0001) The fee amount to attach to this transaction.
         """
-        fromaddress = str(fromaddress)
-        r = self._call('z_sendmany', fromaddress, amounts, minconf, fee)
+        if not isinstance(fromaddress, str):
+            fromaddress = str(fromaddress)
+        r = self._wallet_call('z_sendmany', fromaddress, amounts, minconf, fee)
         return r
@@ -1,20 +1,60 @@
-import binascii
+from functools import lru_cache
+import time
 
 COIN = 100000000
 
+# z_sendmany accepts at most this many zaddr outputs per transaction
+MAX_ZADDR_OUTPUTS = 54
 
+
+@lru_cache(maxsize=8192)
 def hex_decode(msg):
-    msgstr = msg.rstrip('0')
-    if msgstr != 'f6':
-        decoded = binascii.unhexlify(msgstr).decode('ascii')
-        return decoded
+    # A memo starting with 0xf6 carries no message; text memos are padded
+    # to 512 bytes with 0x00.
+    raw = bytes.fromhex(msg)
+    if raw and raw[0] != 0xf6:
+        return raw.rstrip(b'\x00').decode('utf-8', errors='replace')
+
+def format_output(receiver, amount, msg):
+    if not msg:
+        return {"address": receiver, "amount": amount}
+    return {"address": receiver, "amount": amount, "memo": msg.encode('utf-8').hex()}
 
 def format_amounts(receiver, amount, msg):
-    amts_array = []
-    if msg == '':
-        amounts = {"address": receiver, "amount": amount}
-    else:
-        memo = str(binascii.b2a_hex(bytes(msg, encoding="ascii")), 'ascii')
-        amounts = {"address": receiver, "amount": amount, "memo": memo}
-    amts_array.append(amounts)
-    return amts_array
+    return [format_output(receiver, amount, msg)]
+
+def format_amounts_many(outputs):
+    """Format (receiver, amount, msg) tuples as z_sendmany amounts, so one
+    transaction can carry several messages."""
+    # Shielded addresses start with 'z'; taddr outputs do not count
+    zaddr_outputs = sum(1 for receiver, amount, msg in outputs if receiver.startswith('z'))
+    if zaddr_outputs > MAX_ZADDR_OUTPUTS:
+        raise ValueError('z_sendmany accepts at most %d zaddr outputs, got %d' %
+                         (MAX_ZADDR_OUTPUTS, zaddr_outputs))
+    return [format_output(receiver, amount, msg) for receiver, amount, msg in outputs]
+
+class TTLCache(object):
+    """Least-recently-used cache of at most maxsize entries, each of which
+    expires ttl seconds after it is set"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = {}
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[1] <= time.time():
+            return default
+        # Re-insert to mark the entry as most recently used
+        self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, value, ttl):
+        # An existing (possibly expired) entry is replaced, never evicting another
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (value, time.time() + ttl)
+
+    def clear(self):
+        self._entries.clear()
@@ -2,15 +2,26 @@
 
 # Copyright (C) 2017 arcalinea <arcalinea@z.cash>
 
-from zmsg.rpc import Proxy
-import time, sys
+from zmsg.rpc import Proxy, DEFAULT_CACHE_TTL
+import time, random, decimal
 import argparse, textwrap
 from .utils import *
 
 __version__ = "0.1.0"
 
+# Transaction times cached by Zmsg; a tx with FINAL_CONFIRMATIONS or more
+# is treated as final and never expires.
+TX_CACHE_SIZE = 4096
+TX_CACHE_TTL = 60
+FINAL_CONFIRMATIONS = 6
+
+# Polling of z_sendmany operations backs off from POLL_DELAY to
+# POLL_MAX_DELAY seconds and gives up after SEND_TIMEOUT seconds.
+POLL_DELAY = 0.25
+POLL_MAX_DELAY = 8.0
+SEND_TIMEOUT = 120
+
 def main():
-    zmsg = Zmsg()
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
         description=textwrap.dedent('''\
                 Usage:
@@ -25,7 +36,9 @@ def main():
     parser.add_argument("-txval", action="store", default=0.0001, help="Specify the amount of ZEC to send with messages.")
     parser.add_argument("-msg", action="store", help="Send a message.")
     parser.add_argument("-minconf", action="store", help="Set a number of minimum confirmations on messages checked (default=1)")
+    parser.add_argument("-nocache", action="store_true", help="Do not reuse recent z_listaddresses and listunspent results.")
     args = parser.parse_args()
+    zmsg = Zmsg(cache_ttl=0 if args.nocache else DEFAULT_CACHE_TTL)
     if args.command == "sendmsg":
         if args.sendto == None or args.msg == None:
             print("\nError: You must include a recipient z-address and message with the command 'sendmsg'.\n")
@@ -53,30 +66,51 @@ def main():
 
 
 class Zmsg(object):
-    def __init__(self, network='testnet'):
-        self.rpc = Proxy(network=network)
+    def __init__(self, network='testnet', cache_ttl=DEFAULT_CACHE_TTL):
+        self.rpc = Proxy(network=network, cache_ttl=cache_ttl)
+        self._tx_times = TTLCache(TX_CACHE_SIZE)
 
     # checkmsgs
+    def _store_tx_time(self, txid, resp):
+        if resp.get('confirmations', 0) >= FINAL_CONFIRMATIONS:
+            ttl = float('inf')
+        else:
+            ttl = TX_CACHE_TTL
+        self._tx_times.set(txid, resp['time'], ttl)
+        return resp['time']
+
+    def _collect_msgs(self, received):
+        # received maps each zaddr to its z_listreceivedbyaddress result;
+        # times of memo-bearing txs are fetched in a single batch
+        memo_txs = []
+        for zaddr, txs in received.items():
+            for tx in txs:
+                memo = hex_decode(tx['memo'])
+                if memo != None:
+                    memo_txs.append((zaddr, tx, memo))
+        tx_times = {}
+        for zaddr, tx, memo in memo_txs:
+            tx_times[tx['txid']] = self._tx_times.get(tx['txid'])
+        uncached = [txid for txid, t in tx_times.items() if t is None]
+        resps = self.rpc.batch_call('gettransaction', [[txid] for txid in uncached])
+        for txid, resp in zip(uncached, resps):
+            tx_times[txid] = self._store_tx_time(txid, resp)
+        all_msgs = {zaddr: [] for zaddr in received}
+        for zaddr, tx, memo in memo_txs:
+            t = time.ctime(tx_times[tx['txid']])
+            msg = {'time': t, 'amount': tx['amount'], 'memo': memo}
+            all_msgs[zaddr].append(msg)
+        return all_msgs
+
     def received_by_zaddr(self, zaddr, minconf):
-        msgs = []
         txs = self.rpc.z_listreceivedbyaddress(zaddr, minconf)
-        for tx in txs:
-            memo = hex_decode(tx['memo'])
-            if memo != None:
-                resp = self.rpc.gettransaction(tx['txid'])
-                t = time.ctime(resp['time'])
-                amount = tx['amount']
-                msg = {'time': t, 'amount': amount, 'memo': memo}
-                msgs.append(msg)
-        return msgs
+        return self._collect_msgs({zaddr: txs})[zaddr]
 
     def check_msgs(self, minconf=1):
-        all_msgs = {}
         zaddrs = self.rpc.z_listaddresses()
-        for zaddr in zaddrs:
-            msgs = self.received_by_zaddr(zaddr, minconf)
-            all_msgs[zaddr] = msgs
-        return all_msgs
+        received = self.rpc.batch_call('z_listreceivedbyaddress',
+                                       [[zaddr, minconf] for zaddr in zaddrs])
+        return self._collect_msgs(dict(zip(zaddrs, received)))
 
     # Sendmsg
     def find_unspent_taddr(self, amount):
@@ -87,33 +121,44 @@ class Zmsg(object):
                     return tx['address']
 
     def send_msg(self, sender, receiver, amount, msg):
+        self.send_msgs(sender, [(receiver, amount, msg)])
+
+    def send_msgs(self, sender, outputs):
+        # outputs is a list of (receiver, amount, msg) tuples, all sent in
+        # one shielded transaction.
         # if sender is blank, get a new taddr and send from it.
         if sender == '' or sender == None:
-            taddr = self.find_unspent_taddr(amount)
+            total = sum(decimal.Decimal(str(amount)) for receiver, amount, msg in outputs)
+            taddr = self.find_unspent_taddr(total)
             print("No fromaddress provided, sending from {0}".format(taddr))
             sender = taddr
-        amounts = format_amounts(receiver, amount, msg)
+        amounts = format_amounts_many(outputs)
         opid = self.rpc.z_sendmany(sender, amounts)
         response_array = self.rpc.z_getoperationstatus([opid])
         status = response_array[0]['status']
         print('Status of sendmsg: {0}. Operation id: {1}'.format(status, opid))
         start_time = time.time()
-        sys.stdout.write("Sending message...")
-        while status == 'executing':
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            response_array = self.rpc.z_getoperationstatus([opid])
-            status = response_array[0]['status']
-            if status == 'executing':
-                time.sleep(1)
-            elif status == 'success':
-                print("\nSuccess, message sent! OPID: {0}".format(opid))
-            elif status == 'failed':
-                print("\nSending message failed. OPID: {0}".format(opid))
-                raise Exception(response_array[0]['error'])
-            else:
-                if time.time() > start_time + 120:
-                    result = self.rpc.z_getoperationresult([opid])
-                    status = result[0]['status']
-                    print("\nSending timed out, operation result is {0}".format(status))
-                    break
+        delay = POLL_DELAY
+        print("Sending message...", end='')
+        # z_getoperationresult returns [] until the operation has finished,
+        # then returns its result and removes it from zcashd's memory, so it
+        # serves as both the poll and the final fetch.
+        response_array = []
+        if status not in ('queued', 'executing'):
+            response_array = self.rpc.z_getoperationresult([opid])
+        while not response_array:
+            print('.', end='', flush=True)
+            if time.time() - start_time > SEND_TIMEOUT:
+                print("\nSending timed out, operation {0} has not finished".format(opid))
+                return
+            time.sleep(min(delay * random.uniform(0.9, 1.1), POLL_MAX_DELAY))
+            delay = min(delay * 1.5, POLL_MAX_DELAY)
+            response_array = self.rpc.z_getoperationresult([opid])
+        status = response_array[0]['status']
+        if status == 'success':
+            print("\nSuccess, message sent! OPID: {0}".format(opid))
+        elif status == 'failed':
+            print("\nSending message failed. OPID: {0}".format(opid))
+            raise Exception(response_array[0]['error'])
+        else:
+            print("\nSending stopped, operation status is {0}".format(status))